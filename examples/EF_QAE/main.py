@@ -1,284 +1,480 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-from qibo.models import Circuit
-from qibo import hamiltonians, gates, models, matrices
-from qibo.hamiltonians import Hamiltonian
+from qibo import hamiltonians
+from scipy import sparse
 from scipy.optimize import minimize
+from scipy.sparse.linalg import eigsh
 from sklearn.datasets import load_digits
+from joblib import Parallel, delayed
 import argparse
+import collections
+import os
+import threading
+
+try:
+    from numba import njit
+except ImportError: # pragma: no cover
+    njit = None
+
+
+def apply_ry_layer(states, coss, sins, qubits, nqubits=6):
+    """Applies a layer of RY rotations, one per listed qubit, to a batch.
+
+    The half-angle cosines and sines are precomputed by the caller, so a
+    qubit update is one einsum contraction of a 2x2 rotation against the
+    reshaped batch.
+
+    Args:
+        states (np.ndarray): batched states of shape ``(2 ** nqubits, B)``,
+            modified in place.
+        coss (np.ndarray): ``cos(theta/2)`` per rotation and sample, shape
+            ``(len(qubits), B)``.
+        sins (np.ndarray): ``sin(theta/2)`` per rotation and sample, shape
+            ``(len(qubits), B)``.
+        qubits (iterable): qubit id numbers the rotations act on.
+        nqubits (int): total number of qubits.
+
+    Returns:
+        The evolved batched states.
+    """
+    nbatch = states.shape[1]
+    for k, q in enumerate(qubits):
+        rot = np.array([[coss[k], -sins[k]], [sins[k], coss[k]]])
+        view = states.reshape(2 ** q, 2, -1, nbatch)
+        view[...] = np.einsum('xyb,aycb->axcb', rot, view)
+    return states
+
+
+def cz_layer_mask(pairs, nqubits=6):
+    """Combined diagonal sign mask of a sequence of CZ gates.
+
+    Every CZ gate is diagonal, so a fixed sequence of them reduces to a
+    single elementwise multiplication with a ``+-1`` mask.
+
+    Args:
+        pairs (tuple): qubit pairs the CZ gates act on.
+        nqubits (int): total number of qubits.
+
+    Returns:
+        Sign mask of shape ``(2 ** nqubits,)``.
+    """
+    bits = np.arange(2 ** nqubits)
+    mask = np.ones(2 ** nqubits, dtype=np.float32)
+    for q0, q1 in pairs:
+        b0, b1 = nqubits - 1 - q0, nqubits - 1 - q1
+        mask[((bits >> b0) & (bits >> b1) & 1) == 1] *= -1
+    return mask
+
+
+# Sign masks for the two CZ sub-layers of the ansatz.
+CZ_MASK_A = cz_layer_mask(((5, 4), (5, 3), (5, 1), (4, 2), (4, 0)))
+CZ_MASK_B = cz_layer_mask(((5, 4), (5, 2), (4, 3), (5, 0), (4, 1)))
+
+# cos(pi/4) = sin(pi/4), used to rotate cached half-angle trig values when a
+# parameter-shift perturbs one angle by pi/2.
+SQRT2_2 = np.float32(np.sqrt(0.5))
+
+
+if njit is not None:
+    # Numba kernels for the optimization hot path. The explicit pair loops
+    # compile to tight machine code without any per-gate array allocation.
+    # The qubit count is fixed to six, as in the rest of this example.
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _ry_kernel(state, q, cos, sin): # pragma: no cover
+        step = 1 << (6 - 1 - q)
+        for start in range(0, state.shape[0], 2 * step):
+            for i0 in range(start, start + step):
+                i1 = i0 + step
+                for b in range(state.shape[1]):
+                    a, c = state[i0, b], state[i1, b]
+                    state[i0, b] = cos[b] * a - sin[b] * c
+                    state[i1, b] = sin[b] * a + cos[b] * c
+
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _mask_kernel(state, mask): # pragma: no cover
+        for i in range(state.shape[0]):
+            if mask[i] < 0:
+                for b in range(state.shape[1]):
+                    state[i, b] = -state[i, b]
+
+
+def build_ansatz_kernel(layers, compress):
+    """Generates a fully unrolled Numba kernel for a fixed ansatz shape.
+
+    ``layers`` and ``compress`` never change within one optimization run,
+    so the layer loop is partially evaluated into straight-line source with
+    literal qubit and angle indices before compilation, letting LLVM inline
+    and unroll everything.
+
+    Args:
+        layers (int): number of ansatz layers.
+        compress (int): number of discarded/trash qubits.
+
+    Returns:
+        Compiled kernel with signature ``(state, coss, sins, mask_a,
+        mask_b)``, or ``None`` when Numba is not available.
+    """
+    if njit is None: # pragma: no cover
+        return None
+    lines = ["def _unrolled_ansatz(state, coss, sins, mask_a, mask_b):"]
+    index = 0
+    for l in range(layers):
+        for q in range(6):
+            lines.append("    _ry_kernel(state, %d, coss[%d], sins[%d])"
+                         % (q, index, index))
+            index += 1
+        lines.append("    _mask_kernel(state, mask_a)")
+        for q in range(6):
+            lines.append("    _ry_kernel(state, %d, coss[%d], sins[%d])"
+                         % (q, index, index))
+            index += 1
+        lines.append("    _mask_kernel(state, mask_b)")
+    for q in range(6 - compress, 6):
+        lines.append("    _ry_kernel(state, %d, coss[%d], sins[%d])"
+                     % (q, index, index))
+        index += 1
+    # Seed __name__ so the exec-defined function belongs to this module;
+    # otherwise the on-disk cache of the inner kernels records the fake
+    # module '<dynamic>' and fails to load on subsequent runs.
+    namespace = {"__name__": __name__, "_ry_kernel": _ry_kernel,
+                 "_mask_kernel": _mask_kernel}
+    exec("\n".join(lines), namespace)
+    # cache=True is not possible for exec-generated source.
+    return njit(fastmath=True, nogil=True)(namespace["_unrolled_ansatz"])
 
 
 def main(layers, autoencoder, example):
-    
-    def encoder_hamiltonian_simple(nqubits, ncompress):
-        """Creates the encoding Hamiltonian.
+
+    def encoder_diagonal(nqubits, ncompress):
+        """Creates the diagonal of the encoding Hamiltonian.
+
+        The encoding Hamiltonian 0.5 * (I otimes Z + ncompress), with Z the
+        non-interacting Pauli-Z Hamiltonian -sum_i Z_i on the trash qubits,
+        is diagonal, so only its 2**nqubits diagonal entries are built: each
+        entry counts the trash qubits in the |1> state.
+
         Args:
             nqubits (int): total number of qubits.
             ncompress (int): number of discarded/trash qubits.
 
         Returns:
-            Encoding Hamiltonian.
+            Diagonal of the encoding Hamiltonian as a float64 array, so
+            that the final energy reduction accumulates in double
+            precision even though the states are single precision.
+        """
+        z_diag = np.array([1.0, -1.0])
+        z_sum = np.zeros(1)
+        for _ in range(ncompress):
+            z_sum = np.add.outer(z_sum, z_diag).ravel()
+        z_sum = np.tile(z_sum, 2 ** (nqubits - ncompress))
+        return 0.5 * (ncompress - z_sum)
+
+    def compute_angles(params, xs):
+        """Evaluates the EF-QAE angles ``theta[2k]*xs + theta[2k+1]``.
+
+        The angles of consecutive rotations use consecutive parameter pairs,
+        so the whole angle matrix is two strided slices and a broadcast.
+
+        Args:
+            params (np.ndarray): trainable parameters.
+            xs (np.ndarray): feature value of every sample, shape ``(B,)``.
+
+        Returns:
+            Angles in circuit order, shape ``(nangles, B)``.
+        """
+        return params[0::2, None] * xs + params[1::2, None]
+
+    def angle_trig(angles):
+        """Half-angle cosines and sines of a full set of rotation angles.
+
+        Args:
+            angles (np.ndarray): rotation angles in circuit order, shared
+                across the batch (shape ``(nangles,)``) or one set per sample
+                (shape ``(nangles, B)``).
+
+        Returns:
+            Tuple with the ``cos(theta/2)`` and ``sin(theta/2)`` matrices of
+            shape ``(nangles, B)``, evaluated in one vectorized call each.
+        """
+        angles = np.asarray(angles, dtype=np.float32)
+        if angles.ndim == 1:
+            angles = np.repeat(angles[:, None], nsamples, axis=1)
+        half = 0.5 * angles
+        return np.cos(half), np.sin(half)
+
+    def shifted_trig(coss, sins, k, sign):
+        """Trig matrices with angle ``k`` shifted by ``sign * pi/2``.
+
+        A pi/2 angle shift rotates the half-angle by pi/4, so the shifted
+        cosine/sine row is a linear combination of the cached base rows and
+        no new trigonometric calls are needed.
+        """
+        cs, sn = np.copy(coss), np.copy(sins)
+        cs[k] = (coss[k] - sign * sins[k]) * SQRT2_2
+        sn[k] = (sins[k] + sign * coss[k]) * SQRT2_2
+        return cs, sn
+
+    def execute_batched(coss, sins):
+        """Runs the batched ansatz and returns the encoder energy per sample.
+
+        Args:
+            coss (np.ndarray): ``cos(theta/2)`` matrix, shape
+                ``(nangles, B)``.
+            sins (np.ndarray): ``sin(theta/2)`` matrix, shape
+                ``(nangles, B)``.
+
+        Returns:
+            Array with the encoder expectation value of every sample.
         """
-        m0 = hamiltonians.Z(ncompress, numpy=True).matrix
-        m1 = np.eye(2 ** (nqubits - ncompress), dtype=m0.dtype)
-        ham = hamiltonians.Hamiltonian(nqubits, np.kron(m1, m0))
-        return 0.5 * (ham + ncompress)
-    
-    def rotate(theta, x):
-        new_theta = []
-        index = 0
-        for l in range(layers):
-            for q in range(nqubits):
-               new_theta.append(theta[index]*x + theta[index+1])
-               index += 2
-            for q in range(nqubits):
-               new_theta.append(theta[index]*x + theta[index+1])
-               index += 2
-        for q in range(nqubits-compress, nqubits, 1):
-            new_theta.append(theta[index]*x + theta[index+1])
-            index += 2
-        return new_theta
-
-    cost_function_steps = []
+        # Each worker thread reuses its own preallocated buffer so that
+        # parallel gradient evaluations never share scratch memory.
+        buffer = getattr(local, "work", None)
+        if buffer is None or buffer.shape != states.shape:
+            buffer = np.empty_like(states)
+            local.work = buffer
+        np.copyto(buffer, states)
+        if ansatz_kernel is not None:
+            ansatz_kernel(buffer, coss, sins, CZ_MASK_A, CZ_MASK_B)
+        else:
+            index = 0
+            for l in range(layers):
+                apply_ry_layer(buffer, coss[index:index + nqubits],
+                               sins[index:index + nqubits], range(nqubits))
+                index += nqubits
+                buffer *= CZ_MASK_A[:, None]
+                apply_ry_layer(buffer, coss[index:index + nqubits],
+                               sins[index:index + nqubits], range(nqubits))
+                index += nqubits
+                buffer *= CZ_MASK_B[:, None]
+            apply_ry_layer(buffer, coss[index:], sins[index:],
+                           range(nqubits - compress, nqubits))
+        return np.dot(encoder_diag, np.abs(buffer) ** 2)
+
+    def sample_energies(angles):
+        """Encoder energy of every sample for the given rotation angles."""
+        return execute_batched(*angle_trig(angles))
+
+    def gradient_shared(params):
+        """Parameter-shift gradient of the mean energy for shared angles.
+
+        Every parameter enters through a single RY rotation, so the shift
+        rule with +-pi/2 shifts gives the exact gradient from two batched
+        executions per parameter. The base trig matrices are computed once
+        and every shift reuses them through shifted_trig. The shift pairs
+        of different parameters are independent and run in parallel worker
+        threads; the Numba kernels release the GIL.
+        """
+        coss, sins = angle_trig(params)
+
+        def shift_pair(j):
+            up = execute_batched(*shifted_trig(coss, sins, j, 1.0))
+            down = execute_batched(*shifted_trig(coss, sins, j, -1.0))
+            return 0.5 * (np.mean(up) - np.mean(down))
+        return np.array(Parallel(n_jobs=-1, prefer='threads')(
+            delayed(shift_pair)(j) for j in range(len(params))))
+
+    def gradient_factored(params, xs):
+        """Parameter-shift gradient for EF-QAE angles ``theta[2k]*x + theta[2k+1]``.
+
+        The shift rule is applied to each rotation angle for all samples at
+        once and chained with the linear dependence on ``x``. The base trig
+        matrices are computed once and every shift reuses them through
+        shifted_trig. The shift pairs of different angles run in parallel
+        worker threads.
+        """
+        coss, sins = angle_trig(compute_angles(params, xs))
+
+        def shift_pair(k):
+            up = execute_batched(*shifted_trig(coss, sins, k, 1.0))
+            down = execute_batched(*shifted_trig(coss, sins, k, -1.0))
+            return 0.5 * (up - down)
+        shifts = Parallel(n_jobs=-1, prefer='threads')(
+            delayed(shift_pair)(k) for k in range(coss.shape[0]))
+        grad = np.empty(len(params))
+        for k, g in enumerate(shifts):
+            grad[2 * k] = np.mean(g * xs)
+            grad[2 * k + 1] = np.mean(g)
+        return grad
+
+    cost_function_steps = collections.deque()
     nqubits = 6
     compress = 2
-    encoder = encoder_hamiltonian_simple(nqubits, compress)
+    # Expectation values reduce to a dot product between this diagonal and
+    # the state probabilities. Single precision is enough for the state
+    # evolution, but the float64 diagonal makes the dot product accumulate
+    # the cost in double precision so that L-BFGS-B can resolve relative
+    # decreases down to its ftol.
+    encoder_diag = encoder_diagonal(nqubits, compress)
+    # Specialize the compiled ansatz kernel for this run's fixed shape.
+    ansatz_kernel = build_ansatz_kernel(layers, compress)
+    local = threading.local()
     count = [0]
-    
+
     if example == 0:
-        ising_groundstates = []
         lambdas = np.linspace(0.5, 1.0, 20)
-        for lamb in lambdas:
-            ising_ham = -1 * hamiltonians.TFIM(nqubits, h=lamb)
-            ising_groundstates.append(ising_ham.eigenvectors()[0])
-            
+        # The ground states depend only on (nqubits, lambdas), which are
+        # fixed in this example, so the stacked (2**nqubits, B) batch is
+        # computed once and cached on disk for subsequent runs.
+        cachefile = "ising_groundstates_n%d.npy" % nqubits
+        if os.path.isfile(cachefile):
+            states = np.load(cachefile)
+        else:
+            ising_groundstates = []
+            for lamb in lambdas:
+                ising_ham = -1 * hamiltonians.TFIM(nqubits, h=lamb,
+                                                   numpy=True)
+                # Lanczos on the sparse Hamiltonian: only the lowest
+                # eigenvector is needed, not the full eigendecomposition.
+                matrix = sparse.csr_matrix(ising_ham.matrix)
+                _, vectors = eigsh(matrix, k=1, which='SA', tol=1e-10)
+                ising_groundstates.append(vectors[:, 0])
+            states = np.stack(ising_groundstates, axis=1).astype(np.complex64)
+            np.save(cachefile, states)
+        nsamples = len(lambdas)
+
         if autoencoder == 1:
-            circuit = models.Circuit(nqubits)
-            for l in range(layers):
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 3))
-                circuit.add(gates.CZ(5, 1))
-                circuit.add(gates.CZ(4, 2))
-                circuit.add(gates.CZ(4, 0))
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 2))
-                circuit.add(gates.CZ(4, 3))
-                circuit.add(gates.CZ(5, 0))
-                circuit.add(gates.CZ(4, 1))
-            for q in range(nqubits-compress, nqubits, 1):
-                circuit.add(gates.RY(q, theta=0))
-                
             def cost_function_QAE_Ising(params, count):
                 """Evaluates the cost function to be minimized for the QAE and Ising model.
-        
+
                 Args:
                     params (array or list): values of the parameters.
-        
+
                 Returns:
-                    Value of the cost function.
-                """                    
-                cost = 0
-                circuit.set_parameters(params) # this will change all thetas to the appropriate values
-                for i in range(len(ising_groundstates)):
-                    final_state = circuit.execute(np.copy(ising_groundstates[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                    
-                cost_function_steps.append(cost/len(ising_groundstates)) # save cost function value after each step
-        
+                    Value of the cost function and its gradient.
+                """
+                cost = np.mean(sample_energies(params))
+                grad = gradient_shared(params)
+
+                cost_function_steps.append(cost) # save cost function value after each step
+
                 if count[0] % 50 == 0:
-                    print(count[0], cost/len(ising_groundstates))
+                    print(count[0], cost)
                 count[0] += 1
-        
-                return cost/len(ising_groundstates)
-        
+
+                return cost, grad
+
             nparams = 2 * nqubits * layers + compress
             initial_params = np.random.uniform(0, 2*np.pi, nparams)
-        
+
             result = minimize(cost_function_QAE_Ising, initial_params,
-                              args=(count), method='BFGS', options={'maxiter': 5.0e4})
-            
+                              args=(count), jac=True, method='L-BFGS-B',
+                              options={'maxiter': int(5.0e4), 'maxcor': 20,
+                                       'ftol': 1e-8})
+
         elif autoencoder == 0:
-            circuit = models.Circuit(nqubits)
-            for l in range(layers):
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 3))
-                circuit.add(gates.CZ(5, 1))
-                circuit.add(gates.CZ(4, 2))
-                circuit.add(gates.CZ(4, 0))
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 2))
-                circuit.add(gates.CZ(4, 3))
-                circuit.add(gates.CZ(5, 0))
-                circuit.add(gates.CZ(4, 1))
-            for q in range(nqubits-compress, nqubits, 1):
-                circuit.add(gates.RY(q, theta=0))
-                
             def cost_function_EF_QAE_Ising(params, count):
                 """Evaluates the cost function to be minimized for the EF-QAE and Ising model.
-        
+
                 Args:
                     params (array or list): values of the parameters.
-        
+
                 Returns:
-                    Value of the cost function.
-                """                                                               
-                cost = 0
-                for i in range(len(ising_groundstates)):
-                    newparams = rotate(params, lambdas[i])
-                    circuit.set_parameters(newparams)
-                    final_state = circuit.execute(np.copy(ising_groundstates[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                    
-                cost_function_steps.append(cost/len(ising_groundstates)) # save cost function value after each step
-        
+                    Value of the cost function and its gradient.
+                """
+                angles = compute_angles(params, lambdas)
+                cost = np.mean(sample_energies(angles))
+                grad = gradient_factored(params, lambdas)
+
+                cost_function_steps.append(cost) # save cost function value after each step
+
                 if count[0] % 50 == 0:
-                    print(count[0], cost/len(ising_groundstates))
+                    print(count[0], cost)
                 count[0] += 1
-        
-                return cost/len(ising_groundstates)
-        
-            
+
+                return cost, grad
+
+
             nparams = 4 * nqubits * layers + 2 * compress
             initial_params = np.random.uniform(0, 2*np.pi, nparams)
-        
+
             result = minimize(cost_function_EF_QAE_Ising, initial_params,
-                              args=(count), method='BFGS', options={'maxiter': 5.0e4})
-            
+                              args=(count), jac=True, method='L-BFGS-B',
+                              options={'maxiter': int(5.0e4), 'maxcor': 20,
+                                       'ftol': 1e-8})
+
         else:
             raise ValueError("You have to introduce a value of 0 or 1 in the autoencoder argument.")
 
     elif example == 1:
         digits = load_digits()
-        vector_0 = []
-        vector_1 = []
-        for value in [0, 10, 20, 30, 36, 48, 49, 55, 72, 78]:
-            vector_0.append(np.array(digits.data[value])/np.linalg.norm(np.array(digits.data[value])))    
-        for value in [1, 11, 21, 42, 47, 56, 70, 85, 90, 93]:
-            vector_1.append(np.array(digits.data[value])/np.linalg.norm(np.array(digits.data[value])))
-        
+        # Select and normalize each digit family in one vectorized operation.
+        idx0 = [0, 10, 20, 30, 36, 48, 49, 55, 72, 78]
+        idx1 = [1, 11, 21, 42, 47, 56, 70, 85, 90, 93]
+        data = digits.data[idx0 + idx1]
+        data /= np.linalg.norm(data, axis=1, keepdims=True)
+        nsamples = len(idx0) + len(idx1)
+        states = data.T.astype(np.complex64)
+
         if autoencoder == 1:
-            circuit = models.Circuit(nqubits)
-            for l in range(layers):
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 3))
-                circuit.add(gates.CZ(5, 1))
-                circuit.add(gates.CZ(4, 2))
-                circuit.add(gates.CZ(4, 0))
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 2))
-                circuit.add(gates.CZ(4, 3))
-                circuit.add(gates.CZ(5, 0))
-                circuit.add(gates.CZ(4, 1))
-            for q in range(nqubits-compress, nqubits, 1):
-                circuit.add(gates.RY(q, theta=0))
-                
             def cost_function_QAE_Digits(params, count):
                 """Evaluates the cost function to be minimized for the QAE and Handwritten digits.
-        
+
                 Args:
                     params (array or list): values of the parameters.
-        
+
                 Returns:
-                    Value of the cost function.
-                """                                            
-                cost = 0
-                circuit.set_parameters(params) # this will change all thetas to the appropriate values
-                for i in range(len(vector_0)):
-                    final_state = circuit.execute(np.copy(vector_0[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                for i in range(len(vector_1)):
-                    final_state = circuit.execute(np.copy(vector_1[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                    
-                cost_function_steps.append(cost/(len(vector_0)+len(vector_1))) # save cost function value after each step
-        
+                    Value of the cost function and its gradient.
+                """
+                cost = np.mean(sample_energies(params))
+                grad = gradient_shared(params)
+
+                cost_function_steps.append(cost) # save cost function value after each step
+
                 if count[0] % 50 == 0:
-                    print(count[0], cost/(len(vector_0)+len(vector_1)))
+                    print(count[0], cost)
                 count[0] += 1
-        
-                return cost/(len(vector_0)+len(vector_1))
-        
+
+                return cost, grad
+
             nparams = 2 * nqubits * layers + compress
             initial_params = np.random.uniform(0, 2*np.pi, nparams)
-        
+
             result = minimize(cost_function_QAE_Digits, initial_params,
-                              args=(count), method='BFGS', options={'maxiter': 5.0e4})
+                              args=(count), jac=True, method='L-BFGS-B',
+                              options={'maxiter': int(5.0e4), 'maxcor': 20,
+                                       'ftol': 1e-8})
 
         elif autoencoder == 0:
-            circuit = models.Circuit(nqubits)
-            for l in range(layers):
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 3))
-                circuit.add(gates.CZ(5, 1))
-                circuit.add(gates.CZ(4, 2))
-                circuit.add(gates.CZ(4, 0))
-                for q in range(nqubits):
-                    circuit.add(gates.RY(q, theta=0))
-                circuit.add(gates.CZ(5, 4))
-                circuit.add(gates.CZ(5, 2))
-                circuit.add(gates.CZ(4, 3))
-                circuit.add(gates.CZ(5, 0))
-                circuit.add(gates.CZ(4, 1))
-            for q in range(nqubits-compress, nqubits, 1):
-                circuit.add(gates.RY(q, theta=0))
-                
+            # Digits labeled 0 are encoded with x=1 and digits labeled 1 with x=2.
+            xs = np.array([1] * len(idx0) + [2] * len(idx1))
+
             def cost_function_EF_QAE_Digits(params, count):
                 """Evaluates the cost function to be minimized for the EF-QAE and Handwritten digits.
-        
+
                 Args:
                     params (array or list): values of the parameters.
-        
+
                 Returns:
-                    Value of the cost function.
-                """                                    
-                cost = 0
-                newparams = rotate(params, 1)
-                circuit.set_parameters(newparams)
-                for i in range(len(vector_0)):
-                    final_state = circuit.execute(np.copy(vector_0[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                newparams = rotate(params, 2)
-                circuit.set_parameters(newparams)
-                for i in range(len(vector_1)):
-                    final_state = circuit.execute(np.copy(vector_1[i]))
-                    cost += encoder.expectation(final_state).numpy().real
-                    
-                cost_function_steps.append(cost/(len(vector_0)+len(vector_1))) # save cost function value after each step
-        
+                    Value of the cost function and its gradient.
+                """
+                angles = compute_angles(params, xs)
+                cost = np.mean(sample_energies(angles))
+                grad = gradient_factored(params, xs)
+
+                cost_function_steps.append(cost) # save cost function value after each step
+
                 if count[0] % 50 == 0:
-                    print(count[0], cost/(len(vector_0)+len(vector_1)))
+                    print(count[0], cost)
                 count[0] += 1
-        
-                return cost/(len(vector_0)+len(vector_1))
-        
-            
+
+                return cost, grad
+
+
             nparams = 4 * nqubits * layers + 2 * compress
             initial_params = np.random.uniform(0, 2*np.pi, nparams)
-        
+
             result = minimize(cost_function_EF_QAE_Digits, initial_params,
-                              args=(count), method='BFGS', options={'maxiter': 5.0e4})           
-            
+                              args=(count), jac=True, method='L-BFGS-B',
+                              options={'maxiter': int(5.0e4), 'maxcor': 20,
+                                       'ftol': 1e-8})
+
         else:
             raise ValueError("You have to introduce a value of 0 or 1 in the autoencoder argument.")
-            
+
     else:
         raise ValueError("You have to introduce a value of 0 or 1 in the example argument.")
-        
+
     print('Final parameters: ', result.x)
     print('Final cost function: ', result.fun)
 
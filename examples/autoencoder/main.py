@@ -1,71 +1,125 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import numpy as np
-from qibo.models import Circuit
-from qibo import hamiltonians, gates, models
+from qibo import hamiltonians
+from scipy import sparse
 from scipy.optimize import minimize
+from scipy.sparse.linalg import eigsh
 import argparse
 
 
 def main(nqubits, layers, compress, lambdas):
     
-    def encoder_hamiltonian_simple(nqubits, ncompress):
-        """Creates the encoding Hamiltonian.
+    def encoder_diagonal(nqubits, ncompress):
+        """Creates the diagonal of the encoding Hamiltonian.
+
+        The encoding Hamiltonian 0.5 * (I otimes Z + ncompress), with Z the
+        non-interacting Pauli-Z Hamiltonian -sum_i Z_i on the trash qubits,
+        is diagonal, so only its 2**nqubits diagonal entries are built: each
+        entry counts the trash qubits in the |1> state.
+
         Args:
             nqubits (int): total number of qubits.
             ncompress (int): number of discarded/trash qubits.
 
         Returns:
-            Encoding Hamiltonian.
+            Diagonal of the encoding Hamiltonian.
+        """
+        z_diag = np.array([1.0, -1.0])
+        z_sum = np.zeros(1)
+        for _ in range(ncompress):
+            z_sum = np.add.outer(z_sum, z_diag).ravel()
+        z_sum = np.tile(z_sum, 2 ** (nqubits - ncompress))
+        return 0.5 * (ncompress - z_sum)
+
+    def cz_layer_mask(pairs):
+        """Combined diagonal sign mask of a sequence of CZ gates.
+
+        Every CZ gate is diagonal, so a fixed sequence of them reduces to a
+        single elementwise multiplication with a ``+-1`` mask.
+
+        Args:
+            pairs (tuple): qubit pairs the CZ gates act on.
+
+        Returns:
+            Sign mask of shape ``(2 ** nqubits,)``.
         """
-        m0 = hamiltonians.Z(ncompress, numpy=True).matrix
-        m1 = np.eye(2 ** (nqubits - ncompress), dtype=m0.dtype)
-        ham = hamiltonians.Hamiltonian(nqubits, np.kron(m1, m0))
-        return 0.5 * (ham + ncompress)
+        bits = np.arange(2 ** nqubits)
+        mask = np.ones(2 ** nqubits)
+        for q0, q1 in pairs:
+            b0, b1 = nqubits - 1 - q0, nqubits - 1 - q1
+            mask[((bits >> b0) & (bits >> b1) & 1) == 1] *= -1
+        return mask
+
+    def apply_ry_layer(states, thetas):
+        """Applies one RY rotation per qubit to the whole batch in place.
+
+        Args:
+            states (np.ndarray): batched states of shape
+                ``(2 ** nqubits, B)``, modified in place.
+            thetas (np.ndarray): one rotation angle per qubit.
+        """
+        cos, sin = np.cos(thetas / 2.0), np.sin(thetas / 2.0)
+        for q in range(nqubits):
+            rot = np.array([[cos[q], -sin[q]], [sin[q], cos[q]]])
+            view = states.reshape(2 ** q, 2, -1, states.shape[-1])
+            view[...] = np.einsum('xy,aycb->axcb', rot, view)
+
+    # Sign masks for the two CZ sub-layers of the ansatz.
+    mask_even = cz_layer_mask(tuple((q, q + 1)
+                                    for q in range(0, nqubits - 1, 2)))
+    mask_odd = cz_layer_mask(tuple((q, q + 1)
+                                   for q in range(1, nqubits - 2, 2))
+                             + ((0, nqubits - 1),))
 
     def cost_function(params, count):
         """Evaluates the cost function to be minimized.
 
+        The ansatz parameters are shared by all samples, so the whole batch
+        is evolved in one stacked execution: every RY layer is a handful of
+        contractions against the ``(2 ** nqubits, B)`` matrix and every CZ
+        sub-layer one multiplication with its sign mask.
+
         Args:
             params (array or list): values of the parameters.
 
         Returns:
             Value of the cost function.
         """
-        circuit = models.Circuit(nqubits)
+        final = np.copy(states)
+        index = 0
         for l in range(layers):
-            for q in range(nqubits):
-                circuit.add(gates.RY(q, theta=0))
-            for q in range(0, nqubits-1, 2):
-                circuit.add(gates.CZ(q, q+1))
-            for q in range(nqubits):
-                circuit.add(gates.RY(q, theta=0))
-            for q in range(1, nqubits-2, 2):
-                circuit.add(gates.CZ(q, q+1))
-            circuit.add(gates.CZ(0, nqubits-1))
-        for q in range(nqubits):
-            circuit.add(gates.RY(q, theta=0))
-
-        cost = 0
-        circuit.set_parameters(params) # this will change all thetas to the appropriate values
-        for i in range(len(ising_groundstates)):
-            final_state = circuit(np.copy(ising_groundstates[i]))
-            cost += encoder.expectation(final_state).numpy().real
+            apply_ry_layer(final, params[index:index + nqubits])
+            index += nqubits
+            final *= mask_even[:, None]
+            apply_ry_layer(final, params[index:index + nqubits])
+            index += nqubits
+            final *= mask_odd[:, None]
+        apply_ry_layer(final, params[index:])
+        cost = np.mean(np.dot(encoder_diag, np.abs(final) ** 2))
 
         if count[0] % 50 == 0:
-            print(count[0], cost/len(ising_groundstates))
+            print(count[0], cost)
         count[0] += 1
 
-        return cost/len(ising_groundstates)
+        return cost
 
     nparams = 2 * nqubits * layers + nqubits
     initial_params = np.random.uniform(0, 2*np.pi, nparams)
-    encoder = encoder_hamiltonian_simple(nqubits, compress)
+    # Expectation values reduce to a dot product between this diagonal and
+    # the state probabilities.
+    encoder_diag = encoder_diagonal(nqubits, compress)
 
     ising_groundstates = []
     for lamb in lambdas:
-        ising_ham = -1 * hamiltonians.TFIM(nqubits, h=lamb)
-        ising_groundstates.append(ising_ham.eigenvectors()[0])
+        ising_ham = -1 * hamiltonians.TFIM(nqubits, h=lamb, numpy=True)
+        # Lanczos on the sparse Hamiltonian: only the lowest eigenvector is
+        # needed, not the full eigendecomposition.
+        matrix = sparse.csr_matrix(ising_ham.matrix)
+        _, vectors = eigsh(matrix, k=1, which='SA', tol=1e-10)
+        ising_groundstates.append(vectors[:, 0])
+    # Stack the ground states into a single (2**nqubits, B) batch.
+    states = np.stack(ising_groundstates, axis=1).astype(complex)
 
     count = [0]
     result = minimize(lambda p: cost_function(p, count), initial_params,